@@ -1,14 +1,53 @@
 import contextlib
+import errno
+import fcntl
 import os
-import re
-from pathlib import Path
-from typing import Union
-
-import psutil as ps
+from typing import Dict, Iterable, Tuple, Union
+
+__all__ = [
+    "Lock",
+    "LockException",
+    "are_locked",
+    "is_locked",
+    "is_locked_by_self",
+    "lock",
+    "pid_file_name",
+    "unlock",
+]
+
+# Directories can be given as str, bytes, or path-like objects.
+_Directory = Union[str, bytes, os.PathLike]
 
 # Default name of the pid file.
 pid_file_name = ".pid"
 
+# The pid file is read with a single read call of this size.
+_MAX_PIDFILE_SIZE = 16
+
+# Errors of os.link on file systems without hard links.
+_NO_HARD_LINKS_ERRNOS = (errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP)
+
+# Largest value of pid_t, bigger numbers cannot be a pid.
+_MAX_PID = 2 ** 31 - 1
+
+# pidfd_open(2) is available on Linux 5.3+ with Python 3.9+.
+_HAS_PIDFD_OPEN = hasattr(os, "pidfd_open")
+
+# Pid of the current process, and its pid file content,
+# refreshed in forked children.
+_SELF_PID = os.getpid()
+_SELF_PID_BYTES = str(_SELF_PID).encode("ascii")
+
+
+def _refresh_self_pid() -> None:
+    global _SELF_PID, _SELF_PID_BYTES
+    _SELF_PID = os.getpid()
+    _SELF_PID_BYTES = str(_SELF_PID).encode("ascii")
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_refresh_self_pid)
+
 
 class LockException(Exception):
     """Exception used for the pid file locking mechanism."""
@@ -16,9 +55,9 @@ class LockException(Exception):
     pass
 
 
-def _make_pid_path(directory: str) -> Path:
+def _make_pid_path(directory: str) -> str:
     """Builds the path for the pid file."""
-    return Path(directory / pid_file_name)
+    return os.path.join(directory, pid_file_name)
 
 
 def _read_pidfile(directory: str) -> Union[None, int]:
@@ -32,50 +71,343 @@ def _read_pidfile(directory: str) -> Union[None, int]:
         value from the pid file or None if the file doesn't exist
         or the value is not a valid integer
     """
-    pid_path = _make_pid_path(directory)
-    with contextlib.suppress(FileNotFoundError), open(pid_path, "r") as f:
-        data = f.read()
-        if re.match("^[0-9]+$", data):
-            return int(data)
+    return _read_pid_path(_make_pid_path(directory))
+
+
+def _read_pid_path(pid_path: str) -> Union[None, int]:
+    """Reads the pid file from the path, see `_read_pidfile`."""
+    # Most often there is no pid file, os.access checks that without
+    # raising FileNotFoundError. The file can still disappear before open.
+    if not os.access(pid_path, os.F_OK):
+        return None
+    try:
+        fd = os.open(pid_path, os.O_RDONLY)
+    except FileNotFoundError:
+        return None
+    try:
+        data = os.read(fd, _MAX_PIDFILE_SIZE)
+    finally:
+        os.close(fd)
+    return _parse_pid(data)
+
+
+def _parse_pid(data: bytes) -> Union[None, int]:
+    """Parses the pid file content, returns None if it's not a valid pid."""
+    # A file filling the whole buffer cannot contain just a pid.
+    if len(data) >= _MAX_PIDFILE_SIZE:
+        return None
+    # bytes.isdigit accepts only ASCII digits, unlike str.isdigit.
+    data = data.strip()
+    if data.isdigit():
+        pid = int(data)
+        if pid <= _MAX_PID:
+            return pid
     return None
 
 
-def _write_pidfile(directory: str, pid: int = None) -> None:
+def _write_pidfile(directory: str, pid: int = None, exclusive: bool = False) -> None:
     """Writes the pid to the pidfile in the directory.
 
+    The pid is written to a temporary `.pid.*` file first, which is then moved
+    to the pid file path, so nobody can read a partially written pid file.
+    If the process is killed in between, the temporary file is left behind.
+
     Args:
         directory: directory for the pid file
         pid: pid to write, defaults to the current process id
+        exclusive: if True, then an existing pid file is not replaced
+
+    Raises:
+        FileExistsError: if `exclusive` is set and the pid file already exists
+
+    """
+    data = _SELF_PID_BYTES if pid is None else str(pid).encode("ascii")
+    pid_path = _make_pid_path(directory)
+    fd, tmp_path = _create_tmp_pidfile(os.path.dirname(pid_path))
+    try:
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        if exclusive:
+            _link_pidfile(tmp_path, pid_path, data)
+        else:
+            os.replace(tmp_path, pid_path)
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(tmp_path)
+
+
+def _create_tmp_pidfile(dir_path: str) -> Tuple[int, str]:
+    """Creates a new temporary `.pid.*` file in the directory.
 
+    Unlike `tempfile.mkstemp`, the file mode respects the process umask,
+    the same way as for the pid file itself.
+
+    Returns:
+        a tuple with the file descriptor opened for writing, and the file path
     """
-    pid = pid or os.getpid()
-    with open(_make_pid_path(directory), "w+") as f:
-        f.write(str(pid))
+    while True:
+        tmp_path = os.path.join(dir_path, f".pid.{os.urandom(6).hex()}")
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            continue
+        return fd, tmp_path
+
+
+def _link_pidfile(tmp_path: str, pid_path: str, data: bytes) -> None:
+    """Creates the pid file from the temporary file, fails if it already exists."""
+    try:
+        # Creating a hard link fails if the target exists.
+        os.link(tmp_path, pid_path)
+        return
+    except OSError as e:
+        if e.errno not in _NO_HARD_LINKS_ERRNOS:
+            raise
+
+    # The file system doesn't support hard links (e.g. vfat or SMB),
+    # so the file is visible for a moment before the pid is written.
+    fd = os.open(pid_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
 
 
 def _does_pid_exist(pid: int) -> bool:  # noqa: FNE005
-    if pid is None:
+    """Checks if the pid is a running process.
+
+    Ids of threads, other than the main thread of a process,
+    are not treated as running processes.
+    """
+    global _HAS_PIDFD_OPEN
+    # kill(0, 0) would signal our own process group, so it always succeeds.
+    if pid is None or pid <= 0:
+        return False
+    if _HAS_PIDFD_OPEN:
+        try:
+            os.close(os.pidfd_open(pid))
+        except ProcessLookupError:
+            return False
+        except OSError as e:
+            # A thread id, which is not a process, gives ENOENT
+            # (or EINVAL on older kernels).
+            if e.errno in (errno.ENOENT, errno.EINVAL):
+                return False
+            # Linux older than 5.3 doesn't have the syscall,
+            # and some seccomp profiles block it with EPERM.
+            if e.errno not in (errno.ENOSYS, errno.EPERM):
+                raise
+            _HAS_PIDFD_OPEN = False
+        else:
+            return True
+    # Signal 0 only performs the existence and permission checks.
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
         return False
-    return ps.pid_exists(pid)
+    except PermissionError:
+        # The process exists, but belongs to another user.
+        pass
+    # On Linux kill also accepts thread ids, which pidfd_open rejects.
+    return not _is_thread_id(pid)
 
 
-def is_locked(directory: str) -> bool:
+def _is_thread_id(pid: int) -> bool:
+    """Checks if the pid is an id of a thread which is not a process main thread.
+
+    Works only on Linux, on other systems thread ids are not pids,
+    so it always returns False.
+    """
+    try:
+        with open(f"/proc/{pid}/status", "rb") as f:
+            for line in f:
+                if line.startswith(b"Tgid:"):
+                    return int(line.split()[1]) != pid
+    except OSError:
+        pass
+    return False
+
+
+def _describe_pid(pid: int) -> str:
+    """Returns the command line of the process, used only for error messages."""
+    # psutil is imported here, as it's not needed on the common path.
+    import psutil
+
+    try:
+        return str(psutil.Process(pid).cmdline())
+    except psutil.Error:
+        # The process may be a zombie, may belong to another user,
+        # or may have just finished.
+        return "[unknown command]"
+
+
+def _read_pidfile_and_check(pid_path: str) -> Tuple[Union[None, int], bool]:
+    """Reads the pid file and checks if its pid is a running process.
+
+    Args:
+        pid_path: path to the pid file
+
+    Returns:
+        a tuple with the pid from the file (or None if there is no valid pid),
+        and a flag telling if the process with this pid is running
+    """
+    pid = _read_pid_path(pid_path)
+    if pid is None:
+        return None, False
+    if pid == _SELF_PID:
+        return pid, True
+    return pid, _does_pid_exist(pid)
+
+
+def _locked_exception(directory: str, pid: Union[None, int]) -> LockException:
+    if pid is None:
+        # The pid file is flocked, but doesn't contain a valid pid.
+        return LockException(
+            f"The directory {directory} is already locked by "
+            f"another process (pid unknown)."
+        )
+    return LockException(
+        f"The directory {directory} is already locked by "
+        f"pid: {pid} - {_describe_pid(pid)}"
+    )
+
+
+def _not_locked_exception(directory: str) -> LockException:
+    return LockException(f"Cannot unlock a not locked directory {directory}.")
+
+
+def _acquire_pidfile(pid_path: str, directory: str) -> Union[None, int]:
+    """Opens the pid file, locks it with flock, and writes the current pid.
+
+    The flock is held as long as the returned file descriptor is open,
+    and is released by the system when the process finishes.
+
+    Args:
+        pid_path: path to the pid file in the directory to lock
+        directory: the directory to lock
+
+    Returns:
+        file descriptor of the locked pid file, or None if the directory
+        is already locked by this process
+
+    Raises:
+        LockException: if the directory is locked by another process
+    """
+    while True:
+        try:
+            fd = os.open(pid_path, os.O_RDWR)
+        except FileNotFoundError:
+            # The file is created with our pid inside, so it's never empty.
+            try:
+                _write_pidfile(directory, exclusive=True)
+            except FileExistsError:
+                # The path exists, but cannot be opened (e.g. a dangling symlink),
+                # or another process has just created it.
+                file_pid, is_running = _read_pidfile_and_check(pid_path)
+                if is_running and file_pid != _SELF_PID:
+                    raise _locked_exception(directory, file_pid)
+                _write_pidfile(directory)
+            continue
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Read the owner's pid through the open descriptor,
+            # instead of opening the file again by its path.
+            try:
+                file_pid = _parse_pid(os.pread(fd, _MAX_PIDFILE_SIZE, 0))
+            finally:
+                os.close(fd)
+            if file_pid == _SELF_PID:
+                return None
+            raise _locked_exception(directory, file_pid)
+
+        # The previous owner could remove the file between our open and flock,
+        # then we hold a lock on a file nobody else can see.
+        try:
+            same_file = os.stat(pid_path).st_ino == os.fstat(fd).st_ino
+        except FileNotFoundError:
+            same_file = False
+        if same_file:
+            break
+        os.close(fd)
+
+    # The pid could be written by the `lock()` function, which doesn't use flock.
+    file_pid = _parse_pid(os.pread(fd, _MAX_PIDFILE_SIZE, 0))
+    if file_pid != _SELF_PID:
+        if _does_pid_exist(file_pid):
+            os.close(fd)
+            raise _locked_exception(directory, file_pid)
+        # Write before truncating, so the file is never empty.
+        os.pwrite(fd, _SELF_PID_BYTES, 0)
+        os.ftruncate(fd, len(_SELF_PID_BYTES))
+    return fd
+
+
+def _release_pidfile(pid_path: str, directory: str, fd: int) -> None:
+    """Removes the pid file locked by `_acquire_pidfile`, and releases the flock.
+
+    Raises:
+        LockException: if the pid file was removed or replaced by somebody else
+    """
+    try:
+        try:
+            same_file = os.stat(pid_path).st_ino == os.fstat(fd).st_ino
+        except FileNotFoundError:
+            same_file = False
+        # Don't remove a pid file which is not ours anymore.
+        if not same_file:
+            raise _not_locked_exception(directory)
+        try:
+            os.unlink(pid_path)
+        except FileNotFoundError:
+            raise _not_locked_exception(directory)
+    finally:
+        os.close(fd)
+
+
+def is_locked(directory: _Directory) -> bool:
     """Checks if the directory is locked.
 
     args:
         directory: path to the directory to check the lock for
     """
-    pid = _read_pidfile(directory)
-    if pid is None:
-        return False
-    return _does_pid_exist(pid)
+    directory = os.fsdecode(directory)
+    _, is_running = _read_pidfile_and_check(_make_pid_path(directory))
+    return is_running
 
 
-def is_locked_by_self(directory: str) -> bool:
-    return _read_pidfile(directory) == os.getpid()
+def are_locked(directories: Iterable[_Directory]) -> Dict[_Directory, bool]:
+    """Checks if the directories are locked.
 
+    Each pid is checked only once, so checking many directories
+    locked by the same process is cheaper than calling `is_locked` for each.
 
-def lock(directory: str) -> Path:
+    args:
+        directories: paths to the directories to check the lock for
+
+    Returns:
+        a dictionary mapping each directory to its `is_locked` result
+    """
+    running = {_SELF_PID: True}
+    result = {}
+    for directory in directories:
+        pid = _read_pidfile(os.fsdecode(directory))
+        if pid is None:
+            result[directory] = False
+            continue
+        if pid not in running:
+            running[pid] = _does_pid_exist(pid)
+        result[directory] = running[pid]
+    return result
+
+
+def is_locked_by_self(directory: _Directory) -> bool:
+    return _read_pidfile(os.fsdecode(directory)) == _SELF_PID
+
+
+def lock(directory: _Directory) -> str:
     """Locks a directory.
 
     The directory can be locked only if:
@@ -97,30 +429,34 @@ def lock(directory: str) -> Path:
         LockException: if the directory cannot be locked
 
     """
+    directory = os.fsdecode(directory)
     path = _make_pid_path(directory)
 
-    file_pid = _read_pidfile(directory)
-    self_pid = os.getpid()
+    file_pid, is_running = _read_pidfile_and_check(path)
 
     # The pid file has this process id, so we allow to lock it again.
-    if file_pid == self_pid:
+    if file_pid == _SELF_PID:
         return path
 
     # If the pid stored in the pid file exists in the system,
     # we should not allow to lock it.
-    if file_pid is not None and ps.pid_exists(file_pid):
-        p = ps.Process(file_pid)
-        raise LockException(
-            f"The directory {directory} is already locked by "
-            f"pid: {p.pid} - {p.cmdline()}"
-        )
+    if is_running:
+        raise _locked_exception(directory, file_pid)
 
-    _write_pidfile(directory, self_pid)
+    try:
+        _write_pidfile(directory, exclusive=True)
+    except FileExistsError:
+        # The pid file contains garbage or a not running pid,
+        # or another process has just locked the directory.
+        file_pid, is_running = _read_pidfile_and_check(path)
+        if is_running and file_pid != _SELF_PID:
+            raise _locked_exception(directory, file_pid)
+        _write_pidfile(directory)
 
     return path
 
 
-def unlock(directory: str) -> None:
+def unlock(directory: _Directory) -> None:
     """Unlocks the directory.
 
     Removes the pid file only if it's locked by the current process
@@ -137,11 +473,13 @@ def unlock(directory: str) -> None:
                        or is locked by another running process.
     """
 
+    directory = os.fsdecode(directory)
     path = _make_pid_path(directory)
 
-    file_pid = _read_pidfile(directory)
+    # A missing file gives no pid, and is reported when removing it below.
+    file_pid, is_running = _read_pidfile_and_check(path)
 
-    if _does_pid_exist(file_pid) and file_pid != os.getpid():
+    if is_running and file_pid != _SELF_PID:
         raise LockException(
             f"Cannot unlock the directory {directory} because "
             f"it's locked by a running process with pid = {file_pid}."
@@ -150,14 +488,20 @@ def unlock(directory: str) -> None:
     try:
         os.remove(path)
     except FileNotFoundError:
-        raise LockException(f"Cannot unlock a not locked directory {directory}.")
+        raise _not_locked_exception(directory)
 
 
 class Lock:
     """A context manager class for easier directory locking."""
 
-    def __init__(self, directory: str):
-        self._directory = directory
+    __slots__ = ("_directory", "_pid_path", "_fd", "_held")
+
+    def __init__(self, directory: _Directory):
+        self._directory = os.fsdecode(directory)
+        self._pid_path = _make_pid_path(self._directory)
+        # Descriptor of the pid file, kept open to hold the flock.
+        self._fd = None
+        self._held = False
 
     @property
     def directory(self) -> str:
@@ -167,16 +511,28 @@ class Lock:
     @property
     def pid_path(self) -> str:
         """Path to the .pid file."""
-        return _make_pid_path(self._directory)
+        return self._pid_path
 
     @property
     def is_locked(self) -> bool:
         """Checks if the directory is locked by this process."""
-        return is_locked_by_self(self._directory)
+        return self._held
 
     def __enter__(self):
-        lock(self._directory)
+        if self._held:
+            # Entering again would drop the descriptor holding the flock.
+            raise LockException(
+                f"The lock for the directory {self._directory} is already entered."
+            )
+        self._fd = _acquire_pidfile(self._pid_path, self._directory)
+        self._held = True
         return self
 
     def __exit__(self, type, value, traceback):  # noqa: A002
-        unlock(self._directory)
+        self._held = False
+        if self._fd is None:
+            # The directory had been already locked by this process.
+            unlock(self._directory)
+            return
+        fd, self._fd = self._fd, None
+        _release_pidfile(self._pid_path, self._directory, fd)
@@ -1,5 +1,8 @@
+import errno
+import fcntl
 import inspect
 import os
+import threading
 import time
 from multiprocessing import Process
 from pathlib import Path
@@ -39,7 +42,7 @@ def test_creating_pid_file(datadir):
     the directory should be locked right away.
     """
     path = jp.lock(datadir)
-    assert path == Path(datadir / ".pid")
+    assert path == os.path.join(datadir, ".pid")
     assert os.path.isfile(path)
 
     with open(path) as f:
@@ -47,6 +50,51 @@ def test_creating_pid_file(datadir):
         assert content == f"{os.getpid()}"
 
 
+def test_locking_leaves_no_temporary_files(datadir):
+    """
+    The pid file is written atomically, no temporary files should be left.
+    """
+    pid_path = Path(datadir / ".pid")
+    with open(pid_path, "w") as f:
+        f.write("GARBAGE")
+
+    jp.lock(datadir)
+
+    assert os.listdir(datadir) == [".pid"]
+
+
+@pytest.mark.parametrize("umask", [0o022, 0o077])
+def test_pidfile_mode_respects_umask(datadir, umask):
+    """
+    The pid file mode should be limited by the process umask.
+    """
+    old_umask = os.umask(umask)
+    try:
+        path = jp.lock(datadir)
+    finally:
+        os.umask(old_umask)
+
+    assert os.stat(path).st_mode & 0o777 == 0o644 & ~umask
+
+
+def test_locking_without_hard_links(datadir, monkeypatch):
+    """
+    Locking should work on file systems which don't support hard links.
+    """
+
+    def link(src, dst):
+        raise PermissionError(errno.EPERM, "Operation not permitted")
+
+    monkeypatch.setattr(os, "link", link)
+
+    path = jp.lock(datadir)
+    assert jp._read_pidfile(datadir) == os.getpid()
+    assert os.listdir(datadir) == [".pid"]
+
+    jp.unlock(datadir)
+    assert os.path.isfile(path) is False
+
+
 def test_locking_locked_directory_for_the_same_process(datadir):
     """
     A process should be able to reenter the lock.
@@ -79,7 +127,7 @@ def test_locking_locked_directory_different_process(datadir):
         p.join()
         raise AssertionError()
 
-    with pytest.raises(sp.LockException):
+    with pytest.raises(jp.LockException):
         jp.lock(datadir)
 
     p.terminate()
@@ -129,7 +177,7 @@ def test_unlocking_not_locked_directory(datadir):
     Unlocking a not locked directory should raise an exception.
     """
 
-    with pytest.raises(sp.LockException):
+    with pytest.raises(jp.LockException):
         jp.unlock(datadir)
 
 
@@ -147,7 +195,7 @@ def test_unlocking_from_another_process_when_locker_runs(datadir):
             time.sleep(0.1)
             break
 
-    with pytest.raises(sp.LockException):
+    with pytest.raises(jp.LockException):
         jp.unlock(datadir)
 
     p.terminate()
@@ -166,7 +214,7 @@ def test_unlocking_from_another_process_when_locker_doesnt_run(datadir):
 
     jp.unlock(datadir)
 
-    assert pid_path.is_file() is False
+    assert os.path.isfile(pid_path) is False
 
 
 def test_pidfile_with_garbage_inside(datadir):
@@ -182,6 +230,33 @@ def test_pidfile_with_garbage_inside(datadir):
     jp.unlock(datadir)
 
 
+def test_pidfile_with_non_ascii_digits_inside(datadir):
+    """
+    Only ASCII digits are a valid pid, other unicode digits are garbage.
+    """
+    pid_path = Path(datadir / ".pid")
+    with open(pid_path, "w", encoding="utf-8") as f:
+        f.write("\u00b2\u0663")
+
+    assert jp._read_pidfile(datadir) is None
+    jp.lock(datadir)
+    jp.unlock(datadir)
+
+
+@pytest.mark.parametrize("content", ["2147483648", "99999999999"])
+def test_pidfile_with_too_big_pid(datadir, content):
+    """
+    A number out of the pid range is garbage, so the directory is not locked.
+    """
+    with open(Path(datadir / ".pid"), "w") as f:
+        f.write(content)
+
+    assert jp._read_pidfile(datadir) is None
+    assert jp.is_locked(datadir) is False
+    jp.lock(datadir)
+    jp.unlock(datadir)
+
+
 def test_checking_is_locked_functions(datadir):
     """A simple test for checking the `is_locked` function."""
     assert jp.is_locked(datadir) is False
@@ -191,6 +266,23 @@ def test_checking_is_locked_functions(datadir):
     assert jp.is_locked(datadir) is False
 
 
+def test_checking_many_directories(datadir):
+    """A simple test for checking the `are_locked` function."""
+    locked = datadir.mkdir("locked")
+    stale = datadir.mkdir("stale")
+    free = datadir.mkdir("free")
+
+    jp.lock(locked)
+    with open(Path(stale / ".pid"), "w") as f:
+        f.write(str(find_non_existing_pid()))
+
+    assert jp.are_locked([locked, stale, free]) == {
+        locked: True,
+        stale: False,
+        free: False,
+    }
+
+
 def test_simple_context_manager(datadir):
     """A simple test for checking the locking context manager."""
     pid_path = jp._make_pid_path(datadir)
@@ -202,4 +294,225 @@ def test_simple_context_manager(datadir):
         assert file_pid == os.getpid()
 
     assert lock.is_locked is False
-    assert pid_path.is_file() is False
+    assert os.path.isfile(pid_path) is False
+
+
+def test_context_manager_in_another_process(datadir):
+    """
+    The context manager should not lock a directory
+    locked with the context manager by another running process.
+    """
+
+    def hold_lock():
+        with jp.Lock(datadir):
+            time.sleep(10)
+
+    p = Process(target=hold_lock)
+    p.start()
+
+    for _ in range(10):
+        if jp.is_locked(datadir):
+            break
+        time.sleep(0.1)
+    else:
+        p.terminate()
+        p.join()
+        raise AssertionError()
+
+    with pytest.raises(jp.LockException), jp.Lock(datadir):
+        pass
+
+    with pytest.raises(jp.LockException):
+        jp.lock(datadir)
+
+    p.terminate()
+    p.join()
+
+    with jp.Lock(datadir) as lock:
+        assert lock.is_locked
+
+
+@pytest.mark.parametrize("use_pidfd", [True, False])
+def test_checking_if_pid_exists(monkeypatch, thread_id, use_pidfd):
+    """
+    Both pidfd_open and kill should give the same results.
+    """
+    monkeypatch.setattr(jp, "_HAS_PIDFD_OPEN", use_pidfd and jp._HAS_PIDFD_OPEN)
+
+    assert jp._does_pid_exist(thread_id) is False
+
+    assert jp._does_pid_exist(os.getpid()) is True
+    assert jp._does_pid_exist(find_non_existing_pid()) is False
+    assert jp._does_pid_exist(None) is False
+    assert jp._does_pid_exist(0) is False
+
+
+@pytest.fixture()
+def thread_id():
+    """
+    A fixture returning the native id of a running thread,
+    which is not the main thread of the process.
+    """
+    started = threading.Event()
+    finish = threading.Event()
+    ids = []
+
+    def run():
+        ids.append(threading.get_native_id())
+        started.set()
+        finish.wait()
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    started.wait()
+    yield ids[0]
+    finish.set()
+    thread.join()
+
+
+@pytest.mark.parametrize("use_pidfd", [True, False])
+def test_pidfile_with_thread_id(datadir, thread_id, monkeypatch, use_pidfd):
+    """
+    A thread id is not a process, so the directory should not be locked.
+    """
+    monkeypatch.setattr(jp, "_HAS_PIDFD_OPEN", use_pidfd and jp._HAS_PIDFD_OPEN)
+
+    with open(Path(datadir / ".pid"), "w") as f:
+        f.write(str(thread_id))
+
+    assert jp.is_locked(datadir) is False
+    assert jp.are_locked([datadir]) == {datadir: False}
+    jp.lock(datadir)
+    jp.unlock(datadir)
+
+
+@pytest.mark.parametrize("content", ["0", "00"])
+def test_pidfile_with_zero_pid(datadir, content):
+    """
+    Pid 0 is not a process, such a pid file should be treated as not locked.
+    """
+    with open(Path(datadir / ".pid"), "w") as f:
+        f.write(content)
+
+    assert jp.is_locked(datadir) is False
+    jp.lock(datadir)
+    assert jp.is_locked_by_self(datadir) is True
+    jp.unlock(datadir)
+
+
+@pytest.mark.parametrize("convert", [str, os.fsencode, Path])
+def test_directory_types(datadir, convert):
+    """
+    The directory can be given as a str, bytes, or a path-like object.
+    """
+    directory = convert(str(datadir))
+
+    path = jp.lock(directory)
+    assert path == os.path.join(str(datadir), ".pid")
+    assert jp.is_locked(directory) is True
+    assert jp.is_locked_by_self(directory) is True
+    jp.unlock(directory)
+    assert jp.is_locked(directory) is False
+
+    with jp.Lock(directory) as lock:
+        assert lock.directory == str(datadir)
+        assert lock.pid_path == path
+
+
+def test_context_manager_replaces_garbage(datadir):
+    """
+    The context manager should replace the whole garbage content with its pid.
+    """
+    pid_path = Path(datadir / ".pid")
+    with open(pid_path, "w") as f:
+        f.write("GARBAGE GARBAGE")
+
+    with jp.Lock(datadir):
+        with open(pid_path) as f:
+            assert f.read() == str(os.getpid())
+        assert os.listdir(datadir) == [".pid"]
+
+
+def test_nested_context_managers(datadir):
+    """
+    The inner context manager unlocks the directory,
+    so the outer one should find it not locked.
+    """
+    outer = jp.Lock(datadir)
+    with pytest.raises(jp.LockException):
+        with outer:  # noqa: PT012
+            with jp.Lock(datadir) as inner:
+                assert inner.is_locked
+
+    assert outer.is_locked is False
+    assert jp.is_locked(datadir) is False
+
+
+def test_context_manager_with_replaced_pidfile(datadir):
+    """
+    The context manager should not remove a pid file,
+    which was replaced while the directory was locked.
+    """
+    pid_path = Path(datadir / ".pid")
+    other_pid = find_non_existing_pid()
+
+    with pytest.raises(jp.LockException):
+        with jp.Lock(datadir):  # noqa: PT012
+            jp._write_pidfile(datadir, other_pid)
+
+    assert jp._read_pidfile(datadir) == other_pid
+    assert pid_path.is_file()
+
+
+def test_context_manager_with_flocked_garbage(datadir):
+    """
+    When the pid file is flocked, but doesn't contain a valid pid,
+    the error should not describe the current process.
+    """
+    pid_path = str(Path(datadir / ".pid"))
+    with open(pid_path, "w") as f:
+        f.write("GARBAGE")
+
+    # A separately opened file description holds the flock,
+    # so the context manager cannot lock it.
+    fd = os.open(pid_path, os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        with pytest.raises(jp.LockException, match="pid unknown"), jp.Lock(datadir):
+            pass
+    finally:
+        os.close(fd)
+
+
+def test_context_manager_with_dangling_symlink(datadir):
+    """
+    A dangling symlink in place of the pid file should be replaced.
+    """
+    pid_path = Path(datadir / ".pid")
+    os.symlink(str(Path(datadir / "missing")), str(pid_path))
+
+    with jp.Lock(datadir) as lock:
+        assert lock.is_locked
+        assert pid_path.is_symlink() is False
+        assert jp._read_pidfile(datadir) == os.getpid()
+
+    assert os.path.lexists(pid_path) is False
+
+
+def test_entering_the_same_context_manager_twice(datadir):
+    """
+    The same lock object cannot be entered again while it's held,
+    and the outer block should still unlock the directory.
+    """
+    lock = jp.Lock(datadir)
+    with lock:
+        fd = lock._fd
+        with pytest.raises(jp.LockException), lock:
+            pass
+        assert lock._fd == fd
+        assert lock.is_locked
+
+    assert lock.is_locked is False
+    assert jp.is_locked(datadir) is False
+    with pytest.raises(OSError):
+        os.fstat(fd)